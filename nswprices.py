@@ -1,19 +1,60 @@
+import atexit
 import json
 import logging
 import os
 import sys
+import time
+import zipfile
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from io import BytesIO
 
 import matplotlib.pyplot as plt
+import numpy as np
 from dateutil import tz
 from disnake import Embed, File, SyncWebhook
 import influxdb_client
 from influxdb_client.domain import WritePrecision
 from influxdb_client.client.exceptions import InfluxDBError
 from influxdb_client.client.write_api import SYNCHRONOUS
+from numba import njit
+import orjson
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+@njit(cache=True)
+def aggregate_prices(fuel_types: np.ndarray, prices: np.ndarray, n_types: int) -> tuple:
+    """Sum, count, min, max and mode of prices for each fuel type index in a single pass. Negative indexes are skipped"""
+    sums = np.zeros(n_types, dtype=np.float64)
+    counts = np.zeros(n_types, dtype=np.int64)
+    mins = np.full(n_types, np.inf, dtype=np.float32)
+    maxs = np.full(n_types, -np.inf, dtype=np.float32)
+
+    # Prices are to a tenth of a cent, so the mode is found by counting tenths of a cent
+    n_bins = 1
+    for price in prices:
+        n_bins = max(n_bins, int(np.rint(price * 10)) + 1)
+    price_counts = np.zeros((n_types, n_bins), dtype=np.int32)
+
+    for i in range(len(prices)):
+        fuel_type = fuel_types[i]
+        if fuel_type < 0:
+            continue
+        price = prices[i]
+        sums[fuel_type] += price
+        counts[fuel_type] += 1
+        mins[fuel_type] = min(mins[fuel_type], price)
+        maxs[fuel_type] = max(maxs[fuel_type], price)
+        price_counts[fuel_type, max(int(np.rint(price * 10)), 0)] += 1
+
+    modes = np.empty(n_types, dtype=np.float32)
+    for fuel_type in range(n_types):
+        modes[fuel_type] = price_counts[fuel_type].argmax() / 10
+    return sums, counts, mins, maxs, modes
 
 
 class NSWFuelPriceTrends:
@@ -22,6 +63,7 @@ class NSWFuelPriceTrends:
     hour_trigger = 8
     minute_trigger = 58
     graph_history_days = 30
+    graph_dpi = 80
 
     def __init__(self):
         # Init log
@@ -34,8 +76,9 @@ class NSWFuelPriceTrends:
             '%(funcName)-12s || %(levelname)-8s || %(message)s'))
         self.log.addHandler(shandler)
 
-        # Init Config
-        config = self.get_config()
+        # Init Config, kept in memory and written back on exit
+        self._config = config = self.get_config()
+        atexit.register(lambda: self.write_config(self._config))
         self.api_key: str = config["api_key"]
         self.api_secret: str = config["api_secret"]
         self.fuel_types: str = config["fuel_types"]
@@ -52,13 +95,28 @@ class NSWFuelPriceTrends:
         self.influx_uri: str = config["influx_uri"]
         self.influx_organization: str = config["influx_organization"]
         self.influx_bucket: str = config["influx_bucket"]
+        # Cached access token, expires_at already has 10 minutes removed
+        self.access_token: str = config.get("access_token")
+        self._expires_at: int = config.get("expires_at", 0)
 
-        with open("codes.json", encoding="utf-8") as f:
-            self.codes: dict = json.load(f)
+        self.codes: dict = json.loads(self.read_small_file("codes.json"))
+        # Fuel types are stored as indexes into codes.json rather than repeated strings
+        self.code_list: list[str] = list(self.codes)
+        self.code_index: dict[str, int] = {code: i for i, code in enumerate(self.code_list)}
+        self._ft_index: list[int] = [self.code_index[fuel_type] for fuel_type in self.fuel_types]
 
         self.tz = tz.gettz(self.tzname)
 
+        # Pool connections per host so TLS sessions are reused between requests
         self.session = Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"User-Agent": "fuelpricedata"})
+
+        # Graph figure, created on first use and reused between runs
+        self._fig: plt.Figure = None
+        self._ax: plt.Axes = None
 
     def to_b64(self, data: str) -> str:
         """Used to encode the API Client ID & Secret to get an access token"""
@@ -72,52 +130,97 @@ class NSWFuelPriceTrends:
         """Returns a timezone aware Datetime Object"""
         return datetime.now(self.tz)
 
+    @staticmethod
+    def read_small_file(path: str) -> bytes:
+        """Read a small file with a single 4 KiB os.read, skipping the buffered text IO layers"""
+        # Config and codes files are always tiny, so plain sync reads are cheaper than any buffering or async IO
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            data = os.read(fd, 4096)
+            # Keep reading if the file doesn't fit in one buffer
+            while len(data) % 4096 == 0 and (chunk := os.read(fd, 4096)):
+                data += chunk
+        finally:
+            os.close(fd)
+        return data
+
     def get_config(self) -> dict:
         """Read and parse config file"""
-        with open("config.json", encoding="utf-8") as f:
-            return json.load(f)
+        return json.loads(self.read_small_file("config.json"))
 
     def write_config(self, config: dict):
         with open("config.json", "w", encoding="utf-8") as f:
             f.write(json.dumps(config, indent=4))    
 
+    @staticmethod
+    def to_columns(stations: list[dict]) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """Split a list of station prices into fuel type categories, a category index per station and prices"""
+        fuel_types, index = np.unique([station["fueltype"] for station in stations], return_inverse=True)
+        prices = np.fromiter((station["price"] for station in stations), dtype=np.float32, count=len(stations))
+        return fuel_types.tolist(), index.astype(np.int8), prices
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _load_day(path: str, mtime: float) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """Read a day of price data as columns, cached by path and modification time"""
+        if path.endswith(".json"):
+            # Legacy format storing the raw API response
+            with open(path, "rb") as f:
+                return NSWFuelPriceTrends.to_columns(orjson.loads(f.read())["prices"])
+        with np.load(path) as data:
+            return orjson.loads(str(data["meta"]))["fueltypes"], data["f"], data["p"]
+
+    def index_fuel_types(self, fuel_types: list[str], index: np.ndarray) -> np.ndarray:
+        """Map a per-file category index to indexes into codes.json, unknown fuel types become -1"""
+        lookup = np.array([self.code_index.get(code, -1) for code in fuel_types], dtype=np.int8)
+        return lookup[index]
+
+    def price_stats(self, fuel_types: np.ndarray, prices: np.ndarray) -> tuple[np.ndarray, ...]:
+        """Station count, average, min, max and mode price for every fuel type in codes.json"""
+        sums, counts, mins, maxs, modes = aggregate_prices(fuel_types, prices, len(self.code_list))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return counts, sums / counts, mins, maxs, modes
+
+    def load_day(self, date: datetime) -> tuple[np.ndarray, np.ndarray]:
+        """Load a day of price data as fuel type indexes and prices"""
+        path = date.strftime("prices/%Y/%m/%d.npz")
+        if not os.path.exists(path):
+            path = date.strftime("prices/%Y/%m/%d.json")
+        fuel_types, index, prices = self._load_day(path, os.path.getmtime(path))
+        return self.index_fuel_types(fuel_types, index), prices
+
     def get_transaction_id(self) -> str:
         """Get unique transaction ID and iterate by one"""
-        config = self.get_config()
-        config["transaction_id"] = config.get("transaction_id", 0) + 1
-        self.write_config(config)
-        return str(config["transaction_id"])
+        self._config["transaction_id"] = self._config.get("transaction_id", 0) + 1
+        return str(self._config["transaction_id"])
 
-    def is_access_token_expired(self, config: dict) -> bool:
-        return config.get("expires_at", 0) < datetime.utcnow().timestamp() or not config.get("access_token", None)
+    def is_access_token_expired(self) -> bool:
+        return self._expires_at < time.time() or not self.access_token
 
     def fetch_access_token(self) -> None:
-        """Fetches new access token if needed or assigns a cached token to self.access_token"""
-        config = self.get_config()
-        if self.is_access_token_expired(config):
-            self.log.info("Fetching new access token")
-            header = {
-                "Authorization": f"Basic {self.to_b64(f'{self.api_key}:{self.api_secret}')}"
-            }
-            response = self.session.get(
-                f"{self.base}/oauth/client_credential/accesstoken?grant_type=client_credentials", headers=header)
-            rj = response.json()
-            self.access_token, config["access_token"] = rj["access_token"], rj["access_token"]
-            # Write expires_in date, removing 10 minutes just in case
-            config["expires_at"] = int(datetime.utcnow().timestamp()) + int(rj["expires_in"]) - 600
-            self.write_config(config)
-            self.log.info("Got access token")
-        else:
-            self.access_token = config["access_token"]
-
-    def fetch_todays_prices(self, now: datetime) -> dict:
+        """Fetches new access token if the cached self.access_token has expired"""
+        if not self.is_access_token_expired():
+            return
+        self.log.info("Fetching new access token")
+        header = {
+            "Authorization": f"Basic {self.to_b64(f'{self.api_key}:{self.api_secret}')}"
+        }
+        response = self.session.get(
+            f"{self.base}/oauth/client_credential/accesstoken?grant_type=client_credentials", headers=header)
+        rj = orjson.loads(response.content)
+        self.access_token = self._config["access_token"] = rj["access_token"]
+        # Write expires_in date, removing 10 minutes just in case
+        self._expires_at = self._config["expires_at"] = int(time.time()) + int(rj["expires_in"]) - 600
+        self.write_config(self._config)
+        self.log.info("Got access token")
+
+    def fetch_todays_prices(self, now: datetime) -> tuple[np.ndarray, np.ndarray]:
         # Check if today has already been requested
         print(now)
-        file_date = now.strftime("prices/%Y/%m/%d.json")
+        file_date = now.strftime("prices/%Y/%m/%d.npz")
         try:
-            with open(file_date) as f:
-                return json.load(f)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return self.load_day(now)
+        except (FileNotFoundError, ValueError, EOFError, zipfile.BadZipFile):
             pass
 
         self.log.info("Fetching today's prices")
@@ -132,28 +235,23 @@ class NSWFuelPriceTrends:
         response = self.session.get(
             f"{self.base}/FuelPriceCheck/v2/fuel/prices?states=NSW", headers=header)
         if response.status_code != 200:
-            self.log.error(f"{response.status_code}: {response.json()}")
+            self.log.error(f"{response.status_code}: {response.text}")
             return
-        rj: dict = response.json()
-        # Add request timestamp to file for later use
-        rj["request_time"] = int(now.timestamp())
+        rj: dict = orjson.loads(response.content)
 
         # Create history folder
-        if not os.path.isdir("prices"):
-            os.mkdir("prices")
-        if not os.path.isdir(f"prices/{now.year}"):
-            os.mkdir(f"prices/{now.year}")
-        if not os.path.isdir(f"prices/{now.year}/{now.month:02d}"):
-            os.mkdir(f"prices/{now.year}/{now.month:02d}")
-
-        # Remove uncessary data to save space
-        rj.pop("stations", None)
+        os.makedirs(f"prices/{now.year}/{now.month:02d}", exist_ok=True)
+
         print(f"prices/{now.year}/{now.month:02d}")
-        
+
+        # Only keep fuel types and prices, stored as columns to save space
+        fuel_types, index, prices = self.to_columns(rj["prices"])
+        # Add request timestamp to file for later use
+        meta = {"request_time": int(now.timestamp()), "fueltypes": fuel_types}
+
         # Write newly fetched data
-        with open(file_date, "w") as f:
-            f.write(json.dumps(rj, indent=4))
-        return rj
+        np.savez_compressed(file_date, f=index, p=prices, meta=orjson.dumps(meta).decode())
+        return self.index_fuel_types(fuel_types, index), prices
 
     def update_data(self):
         # Check if expired and then fetch new token if so
@@ -161,24 +259,28 @@ class NSWFuelPriceTrends:
 
         now = self.datenow()
 
-        prices = self.fetch_todays_prices(now)
-
-        total_prices: dict[str, list] = {}
-
-        for station in prices["prices"]:
-            if total_prices.get(station["fueltype"], None) == None:
-                total_prices[station["fueltype"]] = []
-            total_prices[station["fueltype"]].append(station["price"])
+        fuel_types, totals = self.fetch_todays_prices(now)
 
         self.log.info("Fuel Averages and Station Count")
-        for fuel_type, total in total_prices.items():
+        counts, averages, *_ = self.price_stats(fuel_types, totals)
+        for i in np.flatnonzero(counts):
             print(
-                f"{self.codes[fuel_type]}: {round(sum(total)/len(total), 2)} || Stations: {len(total)}")
+                f"{self.codes[self.code_list[i]]}: {round(float(averages[i]), 2)} || Stations: {counts[i]}")
 
         self.generate_graph(now)
 
+    def get_figure(self) -> tuple[plt.Figure, plt.Axes]:
+        """Returns a cleared figure and axes for the graph, only creating them on the first call"""
+        if self._fig is None:
+            self._fig, self._ax = plt.subplots()
+        else:
+            self._ax.clear()
+            for legend in list(self._fig.legends):
+                legend.remove()
+        return self._fig, self._ax
+
     def generate_graph(self, now: datetime):
-        fig, ax = plt.subplots()
+        fig, ax = self.get_figure()
         now_tz_inaccurate = now.astimezone(self.tz)
         now_tz = datetime(now_tz_inaccurate.year, now_tz_inaccurate.month, now_tz_inaccurate.day, 9, 0, 0, 0, self.tz)
 
@@ -186,14 +288,16 @@ class NSWFuelPriceTrends:
 
         # How many days to go back
 
-        #                       day  raw data
-        price_history_raw: dict[str, dict[str, dict]] = {}
+        #                       day      fuel types  prices
+        price_history_raw: dict[str, tuple[np.ndarray, np.ndarray]] = {}
         # Create a dictionary that contains each day of raw data fuel prices with the key being day/month.
-        for i in range(0, self.graph_history_days):
-            delta = now_tz-timedelta(days=i)
+        # Days are read in parallel as the small reads are latency bound on a cold cache.
+        deltas = [now_tz-timedelta(days=i) for i in range(0, self.graph_history_days)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            days = [executor.submit(self.load_day, delta) for delta in deltas]
+        for delta, day in zip(deltas, days):
             try:
-                with open(f"prices/{delta.strftime('%Y/%m/%d.json')}") as f:
-                    price_history_raw[delta.strftime("%d/%m/%Y")] = json.load(f)
+                price_history_raw[delta.strftime("%d/%m/%Y")] = day.result()
             except FileNotFoundError:
                 self.log.warning(f"Failed to get data for day {delta.strftime('%d/%m/%Y')}")
                 continue
@@ -202,47 +306,38 @@ class NSWFuelPriceTrends:
         # Data is from newest to oldest
         price_history: dict[str, list[int]] = {k: [] for k in self.fuel_types}
 
-        for day in price_history_raw.values():
-
-            prices_for_day: dict[str, list[int]] = {}
-
-            for station in day["prices"]:
-                # Ignore fuel types not in list
-                if station["fueltype"] not in self.fuel_types:
-                    continue
-
-                # Create an array of all prices for that day
-                if prices_for_day.get(station["fueltype"], None) == None:
-                    prices_for_day[station["fueltype"]] = []
-                prices_for_day[station["fueltype"]].append(station["price"])
-
-            # Create averages for each day of fuel data
-            for _type, prices in prices_for_day.items():
-                if price_history.get(_type, None) == None:
-                    price_history[_type] = []
-                price_history[_type].append(round(sum(prices)/len(prices), 2))
-
+        for fuel_types, prices in price_history_raw.values():
+            # Create averages for each day of fuel data, ignoring fuel types not in list
+            counts, averages, *_ = self.price_stats(fuel_types, prices)
+            for _type, i in zip(self.fuel_types, self._ft_index):
+                if counts[i]:
+                    price_history[_type].append(round(float(averages[i]), 2))
+
+        # Only label every few days, the same for every fuel type
+        spaced_dates = []
+        for i, d in enumerate(price_history_raw.keys()):
+            if i % (self.graph_history_days/10) != 0 and i != 0:
+                spaced_dates.append(i*" ")
+            else:
+                spaced_dates.append('/'.join(d.split("/")[:-1]))
         # Reverse data with [::-1] so that is it from oldest to newest
+        spaced_dates = spaced_dates[::-1]
         for prices in price_history.values():
-            spaced_dates = []
-            for i, d in enumerate(list(price_history_raw.keys())):
-                if i % (self.graph_history_days/10) != 0 and i != 0:
-                    spaced_dates.append(i*" ")
-                else:
-                    spaced_dates.append('/'.join(d.split("/")[:-1]))
-            ax.plot(spaced_dates[::-1], prices[::-1], marker="o")
+            ax.plot(spaced_dates, prices[::-1], marker="o")
 
         # self.log.info("Daily Averages - Newest to Oldest")
         # for fuel_type, daily_averages in price_history.items():
         #     self.log.info(f"{fuel_type}: {daily_averages}")
 
         # Make a percentage based change on data from the previous day
-        changes = {}
-        for fuel_type, p_avg in price_history.items():
-            if p_avg[0] != 0 and p_avg[1] != 0:
-                diff = round((p_avg[0]-p_avg[1])/((p_avg[0]+p_avg[1])/2)*100, 2)
-                if diff != 0.0:
-                    changes[fuel_type] = diff
+        # Columns are today and the previous day
+        p_avg = np.array([price_history[fuel_type][:2] for fuel_type in self.fuel_types])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            diffs = np.round((p_avg[:, 0]-p_avg[:, 1])/((p_avg[:, 0]+p_avg[:, 1])/2)*100, 2)
+        changed = (p_avg != 0).all(axis=1) & (diffs != 0.0)
+        changes = {
+            fuel_type: float(diff) for fuel_type, diff, keep in zip(self.fuel_types, diffs, changed) if keep
+        }
         
         changes_up_or_down = "chart_with_upwards_trend" if sum(changes.values())/len(changes.values()) > 0 else "chart_with_downwards_trend"
 
@@ -260,16 +355,15 @@ class NSWFuelPriceTrends:
         ax.set_ylabel("c/Litre")
 
         # Create archive folders
-        if not os.path.isdir("archive"):
-            os.mkdir("archive")
-        if not os.path.isdir(f"archive/{now_tz.year}"):
-            os.mkdir(f"archive/{now_tz.year}")
-        if not os.path.isdir(f"archive/{now_tz.year}/{now_tz.month:02d}"):
-            os.mkdir(f"archive/{now_tz.year}/{now_tz.month:02d}")
-
-        plt.grid(True)
+        os.makedirs(f"archive/{now_tz.year}/{now_tz.month:02d}", exist_ok=True)
+
+        ax.grid(True)
         location = now_tz.strftime("%Y/%m/%d")
-        plt.savefig(f"archive/{location}.png", format='png')
+        # Render once and reuse the PNG for the archive and discord
+        graph = BytesIO()
+        fig.savefig(graph, format='png', dpi=self.graph_dpi)
+        with open(f"archive/{location}.png", "wb") as f:
+            f.write(graph.getvalue())
         if self.enable_ntfy:
             r = self.session.put(self.ntfy_uri,
                         data=f"Today's fuel averages\n{changes_readable}",
@@ -283,23 +377,23 @@ class NSWFuelPriceTrends:
             r.raise_for_status()
             self.log.info("Sent ntfy.sh notification")
         if self.enable_discord:
-            bytes = BytesIO()
-            plt.savefig(bytes, format='png')
-            bytes.seek(0)
+            graph.seek(0)
             hook = SyncWebhook.from_url(self.discord_webhook)
             embed = Embed(title=f"Today's fuel averages ({now.strftime('%Y/%m/%d')}", description=changes_readable)
             embed.set_image(url="attachment://graph.png")
-            hook.send(embed=embed, file=File(fp=bytes, filename="graph.png"))
+            hook.send(embed=embed, file=File(fp=graph, filename="graph.png"))
             self.log.info("Sent discord notification")
-        plt.clf()
-        plt.close()
-        
+
         if self.enable_influx:
             client = influxdb_client.InfluxDBClient(url=self.influx_uri, token=self.influx_token, org=self.influx_organization, timeout=30000)
 
             query_api = client.query_api()
-            query = 'from(bucket:"fuel_price_data")\
-            |> range(start: -1d)'
+            # Only fetch the time of the latest point
+            query = f'from(bucket:"{self.influx_bucket}")\
+            |> range(start: -1d)\
+            |> filter(fn: (r) => r._measurement == "fuel_prices_nsw")\
+            |> last()\
+            |> keep(columns: ["_time"])'
 
             result = query_api.query(org=self.influx_organization, query=query)
             try:
@@ -308,35 +402,36 @@ class NSWFuelPriceTrends:
                 last_data_time = 0
             if last_data_time != now_tz:
 
-                # Re-parse data here as previous parsed data has some fuel types removed.
-                influx_totals: dict[str, dict[int, int]] = {}
-                for station in price_history_raw[now_tz.strftime("%d/%m/%Y")]["prices"]:
-                    if influx_totals.get(station["fueltype"], None) is None:
-                        influx_totals[station["fueltype"]] = []
-                    influx_totals[station["fueltype"]].append(station["price"])
-                influx_price_data = {k: {} for k in influx_totals.keys()}
-                for fuel_type, total in influx_totals.items():
-                    influx_price_data[fuel_type]["mean"] = float(round(sum(total)/len(total), 2))
-                    influx_price_data[fuel_type]["min"] = float(round(min(total), 2))
-                    influx_price_data[fuel_type]["max"] = float(round(max(total), 2))
-                    influx_price_data[fuel_type]["mode"] = float(round(max(set(total), key=total.count), 2))
-                    # influx_price_data[fuel_type]["raw"] = total.values()
-
-                for fuel_type, fuel_type_data in influx_price_data.items():
-                    point = influxdb_client.Point.from_dict({
+                # Push every fuel type here, not just the ones in the graph
+                counts, averages, mins, maxs, modes = self.price_stats(*price_history_raw[now_tz.strftime("%d/%m/%Y")])
+                influx_price_data: dict[str, dict[str, float]] = {
+                    self.code_list[i]: {
+                        "mean": round(float(averages[i]), 2),
+                        "min": round(float(mins[i]), 2),
+                        "max": round(float(maxs[i]), 2),
+                        "mode": round(float(modes[i]), 2)
+                    } for i in np.flatnonzero(counts)
+                }
+
+                timestamp = int(now_tz.astimezone(timezone.utc).timestamp())
+                points = [
+                    influxdb_client.Point.from_dict({
                         "measurement": "fuel_prices_nsw",
                         "tags": {
                             "type": fuel_type
                         },
                         "fields": fuel_type_data
-                    }).time(int(now_tz.astimezone(timezone.utc).timestamp()), write_precision=WritePrecision.S)
-
-                    write_api = client.write_api(write_options=SYNCHRONOUS)
-                    write_api.write(
-                        "fuel_price_data",
-                        self.influx_organization,
-                        point
-                    )
+                    }).time(timestamp, write_precision=WritePrecision.S)
+                    for fuel_type, fuel_type_data in influx_price_data.items()
+                ]
+
+                # Write all points in a single request
+                write_api = client.write_api(write_options=SYNCHRONOUS)
+                write_api.write(
+                    bucket=self.influx_bucket,
+                    org=self.influx_organization,
+                    record=points
+                )
                 self.log.info("Pushed data to influxdb")
             else:
                 self.log.info("Skipping database push, data already exists")